@@ -1,21 +1,99 @@
 """Collect posts data from fishbrain."""
 
 import argparse
-import csv
-import json
+import asyncio
+import collections
+import concurrent.futures
+import gzip
+import io
 import os
-
-import pygeoprocessing
+import shelve
+import shutil
+
+import aiohttp
+import numpy
+import orjson
+import pyarrow
+import pyarrow.csv
+import pyarrow.parquet
 import shapely
-import shapely.wkt
 import taskgraph
 from osgeo import osr, ogr, gdal
 
-from queries import query_catch
+from queries import BATCH_SIZE
+from queries import BBOX_QUERY
 from queries import query_bounding_box
+from queries import query_bounding_box_batch
+
+# Upper bound on batches of grid cells being collected at the same time.
+MAX_CONCURRENT_REQUESTS = 64
+# Fishbrain returns at most this many catches for a bounding box.
+MAX_CATCHES = 10000
+# Boxes with more catches than this are split into quadrants. Pages of a box
+# can only be fetched one after the other, so leaves are kept to 4 pages of 50
+# catches and many leaves are paginated at the same time instead.
+MAX_LEAF_CATCHES = 200
+# Records of grid cells are spread over this many gzipped JSON lines files.
+N_SHARDS = 16
+# Catches are parsed and written in tables of at most this many rows, unless
+# a single grid cell holds more.
+MAX_BATCH_ROWS = 10000
+# Quadrants are not split further than this. A grid cell is then divided
+# into cells 256 times narrower, and the child codes of all levels must fit
+# in 32 bits, which allows 16 levels at most.
+MAX_LEVEL = 8
+
+# Columns of the catches table, in order.
+CATCH_SCHEMA = pyarrow.schema([
+    ('centroid_x', pyarrow.float64()),
+    ('centroid_y', pyarrow.float64()),
+    ('postID', pyarrow.string()),
+    ('caughtAtGmt', pyarrow.string()),
+    ('fishingWaterID', pyarrow.string()),
+    ('fishingWaterName', pyarrow.string()),
+    ('fishingWaterLon', pyarrow.float64()),
+    ('fishingWaterLat', pyarrow.float64()),
+    ('fishingMethod', pyarrow.string()),
+    ('catchAndRelease', pyarrow.bool_()),
+    ('speciesID', pyarrow.string()),
+    ('speciesName', pyarrow.string()),
+    ('length_meters', pyarrow.float64()),
+    ('weight_kg', pyarrow.float64()),
+    ('hasExactPosition', pyarrow.bool_()),
+    ('locationPrivacy', pyarrow.string()),
+    ('userID', pyarrow.string()),
+])
+
+
+def _write_polygons(polygon_array, spat_ref, target_path):
+    """Write polygons to a new ESRI Shapefile, in one transaction.
+
+    Args:
+        polygon_array (numpy.ndarray): shapely polygons to write.
+        spat_ref (osr.SpatialReference): spatial reference of the polygons.
+        target_path (string): path to the shapefile, replaced if it exists.
 
+    Returns:
+        None
 
-def grid_vector(vector_path, cell_size, out_grid_vector_path):
+    """
+    driver = gdal.GetDriverByName('ESRI Shapefile')
+    if os.path.exists(target_path):
+        driver.Delete(target_path)
+    vector = driver.Create(target_path, 0, 0, 0, gdal.GDT_Unknown)
+    layer = vector.CreateLayer('grid', spat_ref, ogr.wkbPolygon)
+    layer_defn = layer.GetLayerDefn()
+    layer.StartTransaction()
+    for polygon_wkb in shapely.to_wkb(polygon_array):
+        feature = ogr.Feature(layer_defn)
+        feature.SetGeometry(ogr.CreateGeometryFromWkb(polygon_wkb))
+        layer.CreateFeature(feature)
+    layer.CommitTransaction()
+
+
+def grid_vector(
+        vector_path, cell_size, out_grid_vector_path,
+        out_lat_lng_vector_path):
     """Convert vector to a regular grid.
 
     Here the vector is gridded such that all cells are contained within the
@@ -30,176 +108,627 @@ def grid_vector(vector_path, cell_size, out_grid_vector_path):
         out_grid_vector_path (string): path to the output ESRI shapefile
             vector that contains a gridded version of ``vector_path``, this file
             should not exist before this call
+        out_lat_lng_vector_path (string): path to the output ESRI shapefile
+            of the same grid, reprojected to lat/lng.
 
     Returns:
-        None
+        list of the bounding boxes of the grid cells in lat/lng, as
+        [minx, miny, maxx, maxy]
 
     """
-    driver = gdal.GetDriverByName('ESRI Shapefile')
-    if os.path.exists(out_grid_vector_path):
-        driver.Delete(out_grid_vector_path)
-
     vector = gdal.OpenEx(vector_path, gdal.OF_VECTOR)
     vector_layer = vector.GetLayer()
     spat_ref = vector_layer.GetSpatialRef()
 
-    original_vector_shapes = []
-    for feature in vector_layer:
-        wkt_feat = shapely.wkt.loads(feature.geometry().ExportToWkt())
-        original_vector_shapes.append(wkt_feat)
+    original_vector_shapes = shapely.from_wkb([
+        bytes(feature.GetGeometryRef().ExportToWkb())
+        for feature in vector_layer])
     vector_layer.ResetReading()
-    original_polygon = shapely.prepared.prep(
-        shapely.ops.unary_union(original_vector_shapes))
-
-    out_grid_vector = driver.Create(
-        out_grid_vector_path, 0, 0, 0, gdal.GDT_Unknown)
-    grid_layer = out_grid_vector.CreateLayer(
-        'grid', spat_ref, ogr.wkbPolygon)
-    grid_layer_defn = grid_layer.GetLayerDefn()
+    original_polygon = shapely.union_all(original_vector_shapes)
 
     extent = vector_layer.GetExtent()  # minx maxx miny maxy
-
-    def _generate_polygon(col_index, row_index):
-        """Generate points for a closed square."""
-        square = [
-            (extent[0] + col_index * cell_size + x,
-             extent[2] + row_index * cell_size + y)
-            for x, y in [
-                (0, 0), (cell_size, 0), (cell_size, cell_size),
-                (0, cell_size), (0, 0)]]
-        return square
     n_rows = int((extent[3] - extent[2]) / cell_size)
     n_cols = int((extent[1] - extent[0]) / cell_size)
 
-    for row_index in range(n_rows):
-        for col_index in range(n_cols):
-            polygon_points = _generate_polygon(col_index, row_index)
-            ring = ogr.Geometry(ogr.wkbLinearRing)
-            for xoff, yoff in polygon_points:
-                ring.AddPoint(xoff, yoff)
-            poly = ogr.Geometry(ogr.wkbPolygon)
-            poly.AddGeometry(ring)
-
-            if original_polygon.contains(
-                    shapely.wkt.loads(poly.ExportToWkt())):
-                poly_feature = ogr.Feature(grid_layer_defn)
-                poly_feature.SetGeometry(poly)
-                grid_layer.CreateFeature(poly_feature)
-
-
-def query_catch_details(in_json_filepath, centroid_dict, target_filepath):
-    print('querying catch details...')
-    data = {}
-    with open(in_json_filepath, 'r') as file:
-        collection = json.load(file)
-    i = 0
-    for item in collection['edges']:
-        i += 1
-        if (i > 0) and (i % 10 == 0):
-            print(f'queried {i}')
-        post_id = item['node']['post']['_id']
-        results = query_catch(post_id)
-        data[post_id] = results | centroid_dict
-
-    print(f'collected details for {i} catches')
-    with open(target_filepath, 'w') as file:
-        file.write(json.dumps(data))
-
-
-def collect(bbox, centroid_dict, target_filepath):
+    # Build every cell of the grid at once, row by row, as closed squares
+    # starting from their lower left corner.
+    col_x, row_y = numpy.meshgrid(
+        extent[0] + numpy.arange(n_cols) * cell_size,
+        extent[2] + numpy.arange(n_rows) * cell_size)
+    square = numpy.array([
+        (0, 0), (cell_size, 0), (cell_size, cell_size),
+        (0, cell_size), (0, 0)])
+    corners = numpy.stack(
+        [col_x.ravel(), row_y.ravel()], axis=-1)[:, numpy.newaxis, :] + square
+
+    # A cell can only lie within the AOI if its 4 corners do, on its boundary
+    # at most. Points are far cheaper to test than squares, so cells are only
+    # built and tested exactly below if all their corners pass.
+    shapely.prepare(original_polygon)
+    corners = corners[shapely.intersects_xy(
+        original_polygon, corners[:, :4, 0], corners[:, :4, 1]).all(axis=1)]
+    cells = shapely.polygons(corners)
+
+    # The dissolved polygon is made of disjoint parts and a cell lies within
+    # it only if it lies within one of them. Each part is tested against the
+    # cells that the tree finds within that part's own bounds, which for an
+    # AOI of scattered polygons is far fewer than within the whole extent.
+    # A single polygon AOI is the case of one part.
+    _, contained_index_list = shapely.STRtree(cells).query(
+        shapely.get_parts(original_polygon), predicate='contains')
+    grid_cells = cells[numpy.unique(contained_index_list)]
+    _write_polygons(grid_cells, spat_ref, out_grid_vector_path)
+
+    # The corners of all kept cells are reprojected in one call, rather than
+    # reading the grid back to reproject it feature by feature.
+    lat_lng_ref = osr.SpatialReference()
+    lat_lng_ref.ImportFromEPSG(4326)  # EPSG 4326 is lat/lng
+    lat_lng_ref.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(spat_ref, lat_lng_ref)
+    lat_lng_corners = numpy.array(transform.TransformPoints(
+        shapely.get_coordinates(grid_cells).tolist())).reshape(
+            -1, len(square), 3)  # transformed points are (x, y, z)
+    lat_lng_cells = shapely.polygons(lat_lng_corners[..., :2])
+    _write_polygons(lat_lng_cells, lat_lng_ref, out_lat_lng_vector_path)
+    return shapely.bounds(lat_lng_cells).tolist()
+
+
+def _hilbert_index(x, y, order):
+    """Get the distance of a cell along a Hilbert curve.
+
+    Args:
+        x (int): column of the cell, in ``[0, 2**order)``.
+        y (int): row of the cell, in ``[0, 2**order)``.
+        order (int): order of the curve.
+
+    Returns:
+        int
+
+    """
+    index = 0
+    side = 1 << (order - 1)
+    while side > 0:
+        rx = 1 if x & side else 0
+        ry = 1 if y & side else 0
+        index += side * side * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = side - 1 - x
+                y = side - 1 - y
+            x, y = y, x
+        side >>= 1
+    return index
+
+
+def _hilbert_sort(bbox_list, order=16):
+    """Sort bounding boxes along a Hilbert curve through their centers.
+
+    Consecutive boxes are then spatially adjacent, which is how they are
+    grouped into batched queries.
+
+    Args:
+        bbox_list (list): bounding boxes as [minx, miny, maxx, maxy].
+        order (int): order of the Hilbert curve the centers are snapped to.
+
+    Returns:
+        a new, sorted list
+
+    """
+    if not bbox_list:
+        return []
+    xs = [(bbox[0] + bbox[2]) / 2 for bbox in bbox_list]
+    ys = [(bbox[1] + bbox[3]) / 2 for bbox in bbox_list]
+    minx, miny = min(xs), min(ys)
+    scale = ((1 << order) - 1) / max(max(xs) - minx, max(ys) - miny, 1e-12)
+    order_list = sorted(range(len(bbox_list)), key=lambda i: _hilbert_index(
+        int((xs[i] - minx) * scale), int((ys[i] - miny) * scale), order))
+    return [bbox_list[i] for i in order_list]
+
+
+def _quad_bbox(bbox, level, code):
+    """Get the bounding box of a quadrant of a grid cell.
+
+    Args:
+        bbox (list): bounding box of the grid cell, [minx, miny, maxx, maxy].
+        level (int): number of times the cell has been split.
+        code (int): Morton code of the quadrant, 2 bits per level with the
+            deepest level in the lowest bits. Of each pair, the low bit is
+            set for the east half and the high bit for the north half.
+
+    Returns:
+        list of [minx, miny, maxx, maxy]
+
+    """
+    col = row = 0
+    for bit in range(level):
+        col |= ((code >> (2 * bit)) & 1) << bit
+        row |= ((code >> (2 * bit + 1)) & 1) << bit
+    width = (bbox[2] - bbox[0]) / (1 << level)
+    height = (bbox[3] - bbox[1]) / (1 << level)
+    return [
+        bbox[0] + col * width, bbox[1] + row * height,
+        bbox[0] + (col + 1) * width, bbox[1] + (row + 1) * height]
+
+
+def _quad_key(root, level, code):
+    """Name a quadrant of a grid cell.
+
+    The name is a fixed-width hex key, the cell's position along the Hilbert
+    curve in the upper 32 bits followed by the quadrant's Morton code, and
+    the level. Sorting names therefore sorts quadrants spatially.
+
+    Args:
+        root (int): position of the grid cell along the Hilbert curve.
+        level (int): number of times the cell has been split.
+        code (int): Morton code of the quadrant, as in ``_quad_bbox``.
+
+    Returns:
+        string
+
+    """
+    key = (root << 32) | (code << (32 - 2 * level))
+    return f'{key:016x}_{level:02d}'
+
+
+class ShardedStore:
+    """Records of grid cells, appended to a few gzipped JSON lines files.
+
+    Each record is a few lines, written one at a time to a pending file of
+    its key, so that the whole record is never held in memory. Once all its
+    lines are written, they are moved to the end of one of ``N_SHARDS``
+    shard files, chosen by the caller, and the key, shard, byte offset and
+    length of the record are appended to an index file. Every line is
+    compressed as its own gzip member, so a record can be appended or
+    truncated alone, while the members of a shard together still read as
+    one gzip file. A record is complete only if it is in the index: bytes a
+    crash left past the last indexed record of a shard are truncated on
+    opening, as are pending files, so shard files hold whole records only
+    and can be read line by line. The index also holds the size of each
+    record, as given by the caller, so that shards can be read in ranges of
+    bounded size.
+
+    Args:
+        directory (string): path to the directory of the files.
+        name (string): prefix of the file names.
+        clear (bool): whether to delete the records already in the files.
+
+    """
+
+    # Version of the formats of the files, saved in manifests alongside the
+    # store so that stores of other versions can be cleared.
+    VERSION = 1
+
+    def __init__(self, directory, name, clear=False):
+        self.directory = directory
+        self.name = name
+        self.index_path = os.path.join(directory, f'{name}_index.jsonl')
+        self.index = {}  # maps key to (shard, offset, length, size)
+        self.pending_dir = os.path.join(directory, f'{name}_pending')
+        shutil.rmtree(self.pending_dir, ignore_errors=True)
+        os.makedirs(self.pending_dir)
+        if clear:
+            for path in [self.index_path] + [
+                    self.shard_path(shard) for shard in range(N_SHARDS)]:
+                if os.path.exists(path):
+                    os.remove(path)
+        if os.path.exists(self.index_path):
+            index_end = 0
+            with open(self.index_path, 'rb') as file:
+                for line in file:
+                    if not line.endswith(b'\n'):
+                        break  # an entry cut short by a crash
+                    key, shard, offset, length, size = orjson.loads(line)
+                    self.index[key] = (shard, offset, length, size)
+                    index_end += len(line)
+            os.truncate(self.index_path, index_end)
+
+        shard_end = [0] * N_SHARDS
+        for shard, offset, length, _ in self.index.values():
+            shard_end[shard] = max(shard_end[shard], offset + length)
+        for shard, end in enumerate(shard_end):
+            path = self.shard_path(shard)
+            if os.path.exists(path) and os.path.getsize(path) > end:
+                os.truncate(path, end)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def shard_path(self, shard):
+        return os.path.join(
+            self.directory, f'{self.name}_{shard:02d}.jsonl.gz')
+
+    def pending_path(self, key):
+        return os.path.join(self.pending_dir, f'{key}.jsonl.gz')
+
+    def range_list(self, max_size):
+        """Split the records into ranges of the shard files.
+
+        Each range is a run of records next to each other in a shard, in
+        shard order, whose sizes add up to at most ``max_size``. A record
+        larger than that is a range of its own. Empty records are left out.
+
+        Args:
+            max_size (int): upper bound on the total size of the records of
+                a range.
+
+        Returns:
+            list of [shard path, byte offset, byte length] ranges, sorted.
+
+        """
+        range_list = []
+        current = None  # [shard, offset, length, size] of the last range
+        for shard, offset, length, size in sorted(self.index.values()):
+            if not length:
+                continue
+            if (current and current[0] == shard and
+                    current[1] + current[2] == offset and
+                    current[3] + size <= max_size):
+                current[2] += length
+                current[3] += size
+            else:
+                current = [shard, offset, length, size]
+                range_list.append(current)
+        return [
+            [self.shard_path(shard), offset, length]
+            for shard, offset, length, _ in range_list]
+
+    def write_line(self, key, line):
+        """Write a line of a record to its pending file.
+
+        Args:
+            key (string): key of the record.
+            line (dict): the line.
+
+        Returns:
+            None
+
+        """
+        with open(self.pending_path(key), 'ab') as file:
+            file.write(gzip.compress(orjson.dumps(line) + b'\n'))
+
+    def append(self, key, shard, size):
+        """Append the pending lines of a record to a shard and to the index.
+
+        A record without any line is indexed as empty. This does not yield
+        to the event loop, so records written by concurrent coroutines are
+        never interleaved.
+
+        Args:
+            key (string): key of the record.
+            shard (int): shard to write the record to.
+            size (int): size of the record, such as its number of items.
+
+        Returns:
+            None
+
+        """
+        pending_path = self.pending_path(key)
+        with open(self.shard_path(shard), 'ab') as file:
+            offset = file.tell()
+            if os.path.exists(pending_path):
+                with open(pending_path, 'rb') as pending_file:
+                    shutil.copyfileobj(pending_file, file)
+                os.remove(pending_path)
+            length = file.tell() - offset
+        with open(self.index_path, 'ab') as file:
+            file.write(
+                orjson.dumps([key, shard, offset, length, size]) + b'\n')
+        self.index[key] = (shard, offset, length, size)
+
+
+async def collect(session, bbox, data=None):
+    """Collect all catches in a bounding box, one page at a time.
+
+    Args:
+        session (aiohttp.ClientSession): session to send the requests with.
+        bbox (list): bounding box as [minx, miny, maxx, maxy] in lat/lng.
+        data (dict): response to the query of the first page, if already
+            fetched, or of the count of catches only, if that is 0.
+
+    Yields:
+        list of the edges of each page
+
+    """
     print(f'Querying with bounding box: {bbox}')
-    cursor = None
-    data = query_bounding_box(bbox, cursor)
+    if data is None:
+        data = await query_bounding_box(session, bbox, None)
     total_count = data['data']['mapArea']['catches']['totalCount']
     print(f'found {total_count} catches to collect')
+    if not total_count:
+        return
+
+    if total_count >= MAX_CATCHES:
+        print(f'{bbox} has more than {MAX_CATCHES} catches. Only the first '
+              f'{MAX_CATCHES} can be queried. Consider choosing a smaller '
+              'cellsize')
+
+    n_collected = 0
+    while True:
+        edge_list = data['data']['mapArea']['catches']['edges']
+        n_collected += len(edge_list)
+        print(f'Collected {n_collected} catches')
+        yield edge_list
+        page_info = data['data']['mapArea']['catches']['pageInfo']
+        if not page_info['hasNextPage']:
+            break
+        data = await query_bounding_box(session, bbox, page_info['endCursor'])
+
+
+async def collect_all(bbox_list, json_dir):
+    """Collect catches for many grid cells concurrently.
+
+    All requests share one HTTP session so that connections are kept alive
+    and reused across cells and pages.
+
+    Cells are ordered along a Hilbert curve and kept in a work queue. Each
+    round, the first page of every queued cell is fetched, ``BATCH_SIZE``
+    neighbouring cells per request. A cell holding more than
+    ``MAX_LEAF_CATCHES`` catches is replaced in the queue by its 4 quadrants,
+    in Z-order, which are probed for their count only in the next round,
+    unless it is a quadrant holding all of its parent's catches: catches
+    share the position of their fishing water, and splitting did not
+    separate them, so splitting again is not likely to either. Quadrants
+    with more than ``MAX_CATCHES`` catches are split regardless, down to
+    ``MAX_LEVEL``, as only that many of them could be collected. Any other
+    cell is a leaf: in the background, it paginates on its own and is
+    saved page by page to a ``ShardedStore`` under its ``_quad_key``, so
+    only one page of it is held at a time. Leaves already in the
+    store are not queried again, and cells that were split are remembered in
+    an on-disk cache keyed by their ``_quad_key``, so an interrupted run
+    resumes where it stopped. The records of a grid cell and all its
+    quadrants go to the same shard. Keys are positions in the grid, so the
+    grid, query and split thresholds are saved to a manifest in
+    ``json_dir``, and the store and cache are cleared if they differ from
+    those of the previous run.
+
+    Each queued node is a ``(root, level, code)`` tuple of integers, as taken
+    by ``_quad_key``. Its bounding box is only computed, from the grid
+    cell's, when it is queried.
+
+    Args:
+        bbox_list (list): bounding boxes of the grid cells, as
+            [minx, miny, maxx, maxy] in lat/lng.
+        json_dir (string): path to the directory to save catches in.
 
-    if total_count >= 10000:
-        print(f'{bbox} has more than 10000 catches. Only the first 10000'
-              'can be queried. Consider choosing a smaller cellsize')
+    Returns:
+        list of [shard path, byte offset, byte length] ranges of the shard
+        files, each holding at most ``MAX_BATCH_ROWS`` catches, as made by
+        ``ShardedStore.range_list``.
 
-    collection = {'edges': []} | centroid_dict
-    has_next = True
-    while has_next:
-        data = query_bounding_box(bbox, cursor)
-        collection['edges'].extend(data['data']['mapArea']['catches']['edges'])
-        page_info = data['data']['mapArea']['catches']['pageInfo']
-        cursor = page_info['endCursor']
-        has_next = page_info['hasNextPage']
-        print(f'Collected {len(collection["edges"])} catches')
-    with open(target_filepath, 'w') as file:
-        file.write(json.dumps(collection))
-
-
-def parse_catch_details(json_list, target_filepath):
-    base_record = {
-        'centroid_x': '',
-        'centroid_y': '',
-        'postID': '',
-        'caughtAtGmt': '',
-        'fishingWaterID': '',
-        'fishingWaterName': '',
-        'fishingWaterLon': '',
-        'fishingWaterLat': '',
-        'fishingMethod': '',
-        'catchAndRelease': '',
-        'speciesID': '',
-        'speciesName': '',
-        'length_meters': '',
-        'weight_kg': '',
-        'hasExactPosition': '',
-        'locationPrivacy': '',
-        'userID': ''
-    }
-    fieldnames = base_record.keys()
-    with open(target_filepath, 'w', newline='', encoding='utf-8') as csvfile:
-        writer = csv.DictWriter(
-            csvfile, fieldnames=fieldnames, delimiter=',', quoting=csv.QUOTE_MINIMAL)
-        writer.writeheader()
-
-        for jsonfile in json_list:
-            print(f'Parsing data in {jsonfile}')
-            with open(jsonfile, 'r') as file:
-                collection = json.load(file)
-            for post_id, details in collection.items():
-                record = base_record.copy()
-                record['postID'] = post_id
-                record['centroid_x'] = details['centroid_x']
-                record['centroid_y'] = details['centroid_y']
-                try:
-                    data = details['data']['catchDetails']['catchPost']
-                except (KeyError, TypeError) as e:
-                    print(f'{post_id}: no details in {jsonfile}')
-                    writer.writerow(record)
-                    continue
-
-                record['caughtAtGmt'] = data['caughtAtGmt']
-                record['catchAndRelease'] = data['catchAndRelease']
-                record['hasExactPosition'] = data['hasExactPosition']
-                record['length_meters'] = data['length']
-                record['weight_kg'] = data['weight']
-                record['locationPrivacy'] = data['locationPrivacy']
-
-                fishingWater = data.get('fishingWater')
-                if fishingWater:
-                    record['fishingWaterID'] = fishingWater['_id']
-                    record['fishingWaterName'] = fishingWater['displayName']
-                    record['fishingWaterLon'] = fishingWater['longitude']
-                    record['fishingWaterLat'] = fishingWater['latitude']
-
-                fishingMethod = data.get('fishingMethod')
-                if fishingMethod:
-                    record['fishingMethod'] = fishingMethod['displayName']
-
-                species = data.get('species')
-                if species:
-                    record['speciesID'] = species['_id']
-                    record['speciesName'] = species['displayName']
-
-                user = data.get('user')
-                if user:
-                    record['userID'] = user['_id']
-
-                writer.writerow(record)
+    """
+    root_bbox_list = _hilbert_sort(bbox_list)
+    queue = collections.deque(
+        (root, 0, 0) for root in range(len(root_bbox_list)))
+    manifest = orjson.dumps({
+        'bbox_list': root_bbox_list,
+        'query': BBOX_QUERY,
+        'max_leaf_catches': MAX_LEAF_CATCHES,
+        'max_level': MAX_LEVEL,
+        'store_version': ShardedStore.VERSION,
+    })
+    manifest_path = os.path.join(json_dir, 'manifest.json')
+    stale = True
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'rb') as file:
+            stale = file.read() != manifest
+    if stale and os.listdir(json_dir):
+        print(f'Clearing catches in {json_dir}, which were collected with '
+              'another grid or query')
+    grid_store = ShardedStore(json_dir, 'grid', clear=stale)
+    leaf_task_list = []
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(
+        limit_per_host=MAX_CONCURRENT_REQUESTS, keepalive_timeout=60)
+
+    def _bbox(node):
+        root, level, code = node
+        return _quad_bbox(root_bbox_list[root], level, code)
+
+    def _split(node):
+        root, level, code = node
+        print(f'Splitting {_bbox(node)} into quadrants')
+        queue.extend((root, level + 1, (code << 2) | i) for i in range(4))
+
+    def _parent_key(node):
+        root, level, code = node
+        return _quad_key(root, level - 1, code >> 2)
+
+    split_cache_path = os.path.join(json_dir, 'split_cache')
+    flag = 'n' if stale else 'c'  # 'n' always creates a new, empty cache
+    with shelve.open(split_cache_path, flag=flag) as split_cache:
+        with open(manifest_path, 'wb') as file:
+            file.write(manifest)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            async def _query_batch(node_list, count_only):
+                async with semaphore:
+                    return await query_bounding_box_batch(
+                        session, [_bbox(node) for node, _ in node_list],
+                        count_only=count_only)
+
+            async def _collect_leaf(node, key, data=None):
+                bbox = _bbox(node)
+                centroid_dict = {
+                    'centroid_x': (bbox[0] + bbox[2]) / 2,
+                    'centroid_y': (bbox[1] + bbox[3]) / 2
+                }
+                n_catches = 0
+                async with semaphore:
+                    async for edge_list in collect(session, bbox, data=data):
+                        grid_store.write_line(key, {
+                            'key': key, **centroid_dict, 'edges': edge_list})
+                        n_catches += len(edge_list)
+                grid_store.append(key, node[0] % N_SHARDS, n_catches)
+
+            while queue:
+                node_list = []
+                while queue:
+                    node = queue.popleft()
+                    key = _quad_key(*node)
+                    if key in split_cache:
+                        _split(node)
+                    elif key not in grid_store:
+                        node_list.append((node, key))
+
+                # Quadrants only exist because their parent was too dense, so
+                # they are likely to be split again and are probed for their
+                # count alone. Grid cells are probed with their first page,
+                # which is kept if they turn out to be leaves.
+                batch_list = []
+                for count_only in (False, True):
+                    probe_list = [
+                        item for item in node_list
+                        if (item[0][1] > 0) == count_only]
+                    batch_list.extend(
+                        (probe_list[i:i + BATCH_SIZE], count_only)
+                        for i in range(0, len(probe_list), BATCH_SIZE))
+                response_list = await asyncio.gather(
+                    *(_query_batch(*batch) for batch in batch_list))
+                for (batch, count_only), responses in zip(
+                        batch_list, response_list):
+                    for (node, key), data in zip(batch, responses):
+                        total_count = (
+                            data['data']['mapArea']['catches']['totalCount']
+                            if data else None)
+                        if (total_count and node[1] < MAX_LEVEL and
+                                total_count > MAX_LEAF_CATCHES and (
+                                    node[1] == 0 or
+                                    total_count >= MAX_CATCHES or
+                                    total_count <
+                                    split_cache[_parent_key(node)])):
+                            split_cache[key] = total_count
+                            _split(node)
+                            continue
+                        # A count of 0 is as good as an empty first page.
+                        if count_only and total_count != 0:
+                            data = None
+                        leaf_task_list.append(asyncio.create_task(
+                            _collect_leaf(node, key, data=data)))
+
+            await asyncio.gather(*leaf_task_list)
+
+    return grid_store.range_list(MAX_BATCH_ROWS)
+
+
+def _cached_values(cache, item, keys):
+    """Get values from a dict, shared with earlier dicts of the same ``_id``.
+
+    Many catches refer to the same fishing water or species. Looking their
+    values up by id means every row reuses one tuple of strings instead of
+    holding its own copies.
+
+    Args:
+        cache (dict): maps ``_id`` to a tuple of values, updated in place.
+        item (dict or None): a dict with an ``_id`` key.
+        keys (tuple): keys of ``item`` to get values for.
+
+    Returns:
+        tuple of values, all None if ``item`` is empty
+
+    """
+    if not item:
+        return (None,) * len(keys)
+    values = cache.get(item['_id'])
+    if values is None:
+        values = cache[item['_id']] = tuple(item.get(key) for key in keys)
+    return values
+
+
+def _iter_catches(shard_path, offset, length):
+    """Stream the catches saved in a range of a shard file, a page at a time.
+
+    Args:
+        shard_path (string): path to a shard file of catches written by
+            ``collect_all``.
+        offset (int): byte offset of the range in the file.
+        length (int): byte length of the range.
+
+    Yields:
+        (catch, page) tuples, where ``page`` is the page of the grid cell,
+        holding its centroid.
+
+    """
+    with open(shard_path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(length)
+    with gzip.GzipFile(fileobj=io.BytesIO(data)) as file:
+        for line in file:
+            page = orjson.loads(line)
+            for edge in page['edges']:
+                yield edge['node'], page
+
+
+def _parse_catches(shard_path, offset, length):
+    """Parse a range of a shard file of catches into a table of catches.
+
+    Args:
+        shard_path (string): path to a shard file of catches written by
+            ``collect_all``.
+        offset (int): byte offset of the range in the file.
+        length (int): byte length of the range.
+
+    Returns:
+        pyarrow.Table with ``CATCH_SCHEMA``
+
+    """
+    print(f'Parsing data in {shard_path} from byte {offset}')
+    fishing_water_cache = {}
+    species_cache = {}
+    row_list = []
+    for data, page in _iter_catches(shard_path, offset, length):
+        (fishing_water_id, fishing_water_name, fishing_water_lon,
+         fishing_water_lat) = _cached_values(
+            fishing_water_cache, data.get('fishingWater'),
+            ('_id', 'displayName', 'longitude', 'latitude'))
+        species_id, species_name = _cached_values(
+            species_cache, data.get('species'), ('_id', 'displayName'))
+        fishingMethod = data.get('fishingMethod') or {}
+        user = data.get('user') or {}
+
+        # In the order of the CATCH_SCHEMA fields.
+        row_list.append((
+            page['centroid_x'],
+            page['centroid_y'],
+            data['post']['_id'],
+            data.get('caughtAtGmt'),
+            fishing_water_id,
+            fishing_water_name,
+            fishing_water_lon,
+            fishing_water_lat,
+            fishingMethod.get('displayName'),
+            data.get('catchAndRelease'),
+            species_id,
+            species_name,
+            data.get('length'),
+            data.get('weight'),
+            data.get('hasExactPosition'),
+            data.get('locationPrivacy'),
+            user.get('_id'),
+        ))
+
+    columns = list(zip(*row_list)) or [[] for _ in CATCH_SCHEMA]
+    return pyarrow.Table.from_arrays(columns, schema=CATCH_SCHEMA)
+
+
+def parse_catch_details(range_list, target_filepath, file_format='csv'):
+    # Ranges are parsed in parallel, each into a table of at most
+    # MAX_BATCH_ROWS rows, and written by this process only, in order. At
+    # most one range per worker is submitted and not yet written, so no more
+    # than that many tables are held at a time.
+    n_workers = os.cpu_count() or 1
+    if file_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(target_filepath, CATCH_SCHEMA)
+    else:
+        writer = pyarrow.csv.CSVWriter(target_filepath, CATCH_SCHEMA)
+    executor = concurrent.futures.ProcessPoolExecutor(n_workers)
+    with executor, writer:
+        future_queue = collections.deque()
+        for shard_range in range_list:
+            if len(future_queue) == n_workers:
+                writer.write_table(future_queue.popleft().result())
+            future_queue.append(
+                executor.submit(_parse_catches, *shard_range))
+        while future_queue:
+            writer.write_table(future_queue.popleft().result())
 
     print(f'Completed. Tabular data is in {target_filepath}')
 
@@ -222,6 +751,12 @@ def main(user_args=None):
         type=int,
         help=('The AOI will be divided into square polygons with width and height '
               'equal to cellsize. Cellsize uses the same units as the AOI coordinate system.'))
+    parser.add_argument(
+        '-f', '--format',
+        choices=['csv', 'parquet'],
+        default='csv',
+        help=('The file format of the catch data table. Parquet files are '
+              'smaller and faster to read back. Defaults to csv.'))
 
     args = parser.parse_args(user_args)
     cache_dir = os.path.join(args.workspace, 'taskgraph_cache')
@@ -230,57 +765,22 @@ def main(user_args=None):
     task_graph = taskgraph.TaskGraph(cache_dir, n_workers=-1)
 
     aoi_path = os.path.join(args.workspace, 'aoi.shp')
-    grid_vector(args.aoi, args.cellsize, aoi_path)
-    lat_lng_ref = osr.SpatialReference()
-    lat_lng_ref.ImportFromEPSG(4326)  # EPSG 4326 is lat/lng
     aoi_path_wgs84 = os.path.join(args.workspace, 'aoi_wgs84.shp')
-    pygeoprocessing.reproject_vector(
-        aoi_path, lat_lng_ref.ExportToWkt(), aoi_path_wgs84)
+    bbox_list = grid_vector(args.aoi, args.cellsize, aoi_path, aoi_path_wgs84)
 
-    csv_filepath = os.path.join(args.workspace, 'catches.csv')
+    table_filepath = os.path.join(args.workspace, f'catches.{args.format}')
     json_dir = os.path.join(args.workspace, 'json')
-    details_dir = os.path.join(json_dir, 'details')
     if not os.path.exists(json_dir):
         os.makedirs(json_dir)
-    if not os.path.exists(details_dir):
-        os.makedirs(details_dir)
-
-    vector = gdal.OpenEx(aoi_path_wgs84)
-    layer = vector.GetLayer()
-
-    details_task_list = []
-    target_details_path_list = []
-    for feature in layer:
-        fid = feature.GetFID()
-        geom = feature.GetGeometryRef()
-        envelope = geom.GetEnvelope()
-        bbox = [envelope[0], envelope[2], envelope[1], envelope[3]]
-        centroid_dict = {
-            'centroid_x': (bbox[0] + bbox[2]) / 2,
-            'centroid_y': (bbox[1] + bbox[3]) / 2
-        }
-        target_grid_filepath = os.path.join(json_dir, f'grid_{fid}.json')
-        collect_task = task_graph.add_task(
-            collect,
-            args=[bbox, centroid_dict, target_grid_filepath],
-            target_path_list=[target_grid_filepath])
-
-        target_details_filepath = os.path.join(details_dir, f'details_{fid}.json')
-        target_details_path_list.append(target_details_filepath)
-        details_task = task_graph.add_task(
-            query_catch_details,
-            args=[target_grid_filepath, centroid_dict, target_details_filepath],
-            target_path_list=[target_details_filepath],
-            dependent_task_list=[collect_task])
-        details_task_list.append(details_task)
+
+    catch_range_list = asyncio.run(collect_all(bbox_list, json_dir))
 
     print('Completed queries.')
 
     parse_task = task_graph.add_task(
         parse_catch_details,
-        args=[target_details_path_list, csv_filepath],
-        target_path_list=[csv_filepath],
-        dependent_task_list=details_task_list)
+        args=[catch_range_list, table_filepath, args.format],
+        target_path_list=[table_filepath])
 
     task_graph.close()
     task_graph.join()
@@ -1,29 +1,177 @@
-import requests
+import asyncio
+import functools
+import hashlib
+import time
+
+import aiohttp
+import orjson
+from aiolimiter import AsyncLimiter
+from tenacity import AsyncRetrying
+from tenacity import retry_if_exception_type
+from tenacity import stop_after_attempt
+from tenacity import wait_exponential
 
 
 BASE_URL = 'https://rutilus.fishbrain.com/graphql'
 
-def query_bounding_box(bbox, cursor):
-    # [minx, miny, maxx, maxy]
-    variables = {
-        "boundingBox": {
-            "southWest": {
-                "latitude": bbox[1],
-                "longitude": bbox[0]
-            },
-            "northEast": {
-                "latitude": bbox[3],
-                "longitude": bbox[2]
-            }
-        },
-        "first": 50,  # 50 seems to be max.
-    }
-    if cursor:
-        variables['after'] = cursor
+# Shared by all coroutines, so the ceiling holds however many bounding boxes
+# and posts are being queried at once. The nominal limit tends to be too
+# aggressive, so stay just under 3 requests per second.
+LIMITER = AsyncLimiter(max_rate=2.9, time_period=1)
+MAX_ATTEMPTS = 6
 
-    query = """
-    query GetCatchesInMapBoundingBox($boundingBox: BoundingBoxInputObject, $first: Int, $after: String, $caughtInMonths: [MonthEnum!], $speciesIds: [String!]) {
-      mapArea(boundingBox: $boundingBox) {
+# Number of bounding boxes whose first page is fetched in one request by
+# query_bounding_box_batch.
+BATCH_SIZE = 10
+
+# Wall-clock time before which no new request should be sent, pushed forward
+# whenever the server asks us to back off.
+_resume_time = 0.0
+
+# Whether to send documents by hash, turned off if the server turns out not
+# to support persisted queries.
+_persisted_queries = True
+# Hashes of the documents this process has registered with the server, which
+# can then be sent by hash only.
+_registered_hashes = set()
+
+
+def _rate_limit_delay(headers):
+    """Get the number of seconds the server asks us to wait, if any.
+
+    Args:
+        headers (mapping): HTTP response headers.
+
+    Returns:
+        float or None
+
+    """
+    retry_after = headers.get('Retry-After')
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            return None  # HTTP-date form, let the retry backoff handle it
+    if headers.get('X-RateLimit-Remaining') == '0':
+        try:
+            reset = float(headers.get('X-RateLimit-Reset'))
+        except (TypeError, ValueError):
+            return None
+        # Reset may be given as an epoch timestamp or as a delta in seconds.
+        if reset > time.time():
+            reset -= time.time()
+        return reset
+    return None
+
+
+async def _post(session, payload):
+    """POST a GraphQL payload under the rate limit, retrying on failure.
+
+    Connection errors, timeouts, 429 and 5xx responses are retried with
+    exponential backoff.
+
+    Args:
+        session (aiohttp.ClientSession): session to send the request with.
+        payload (dict): the JSON body of the request.
+
+    Returns:
+        dict of the decoded JSON response
+
+    """
+    global _resume_time
+    async for attempt in AsyncRetrying(
+            wait=wait_exponential(multiplier=1, max=30),
+            retry=retry_if_exception_type(
+                (aiohttp.ClientError, asyncio.TimeoutError)),
+            stop=stop_after_attempt(MAX_ATTEMPTS),
+            reraise=True):
+        with attempt:
+            wait = _resume_time - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            async with LIMITER:
+                async with session.post(
+                        BASE_URL, data=orjson.dumps(payload),
+                        headers={'Content-Type': 'application/json'}) as r:
+                    delay = _rate_limit_delay(r.headers)
+                    if delay:
+                        _resume_time = max(_resume_time, time.time() + delay)
+                    if r.status == 429 or r.status >= 500:
+                        r.raise_for_status()
+                    try:
+                        return await r.json(
+                            loads=orjson.loads, content_type=None)
+                    except Exception as err:
+                        print(await r.text())
+                        raise err
+
+
+def _error_messages(data):
+    """Get the messages of the GraphQL errors of a response, as strings."""
+    return [str(error.get('message')) for error in data.get('errors') or []]
+
+
+@functools.lru_cache()
+def _query_hash(query):
+    """Get the SHA-256 hex digest identifying a document to the server."""
+    return hashlib.sha256(query.encode('utf-8')).hexdigest()
+
+
+async def _post_query(session, query, variables):
+    """POST a GraphQL query, by hash only when the server has persisted it.
+
+    This follows the Automatic Persisted Queries protocol. Until a document
+    has been registered by this process, it is sent in full along with its
+    hash, which registers it. It is then sent by hash only, and in full again
+    if the server has forgotten that hash. Sending by hash first would have
+    every request already in flight for a new document rejected and sent
+    again. Once the server rejects the extension with a
+    ``PersistedQueryNotSupported`` error, or any other ``PersistedQuery``
+    error for a full document, documents are sent in full without it for the
+    rest of the run.
+
+    Args:
+        session (aiohttp.ClientSession): session to send the request with.
+        query (string): the GraphQL document.
+        variables (dict): values of the variables of the document.
+
+    Returns:
+        dict of the decoded JSON response
+
+    """
+    global _persisted_queries
+    query_hash = _query_hash(query)
+    extensions = {'persistedQuery': {'version': 1, 'sha256Hash': query_hash}}
+    if _persisted_queries and query_hash in _registered_hashes:
+        data = await _post(
+            session, {'extensions': extensions, 'variables': variables})
+        if data.get('data') is not None:
+            return data
+        # Any other error is left to the full document to report.
+        _registered_hashes.discard(query_hash)
+        if 'PersistedQueryNotSupported' in _error_messages(data):
+            print('Persisted queries are not supported')
+            _persisted_queries = False
+
+    payload = {'query': query, 'variables': variables}
+    if _persisted_queries:
+        data = await _post(session, {**payload, 'extensions': extensions})
+        if data.get('data') is not None:
+            _registered_hashes.add(query_hash)
+            return data
+        messages = _error_messages(data)
+        if not any(message.startswith('PersistedQuery')
+                   for message in messages):
+            return data
+        print(f'Persisted queries are not supported: {messages}')
+        _persisted_queries = False
+    return await _post(session, payload)
+
+
+# Selection of catches on a map area, shared by the single and the batched
+# bounding box queries. Only the fields read downstream are requested: the
+# page info and, for each catch, the fields parsed into the catches table.
+_CATCHES_SELECTION = """
         catches(
           first: $first
           after: $after
@@ -32,385 +180,138 @@ def query_bounding_box(bbox, cursor):
         ) {
           totalCount
           pageInfo {
-            startCursor
             hasNextPage
             endCursor
-            __typename
           }
           edges {
             node {
-              ...CatchId
-              createdAt
+              catchAndRelease
               caughtAtGmt
+              fishingMethod {
+                displayName
+              }
+              fishingWater {
+                _id: externalId
+                displayName
+                latitude
+                longitude
+              }
+              hasExactPosition
+              length
+              locationPrivacy
               post {
-                ...PostId
-                catch {
-                  ...CatchId
-                  ...CatchFishingWaterName
-                  ...CatchSpeciesName
-                  __typename
-                }
-                comments {
-                  totalCount
-                  __typename
-                }
-                createdAt
-                displayProductUnits {
-                  totalCount
-                  __typename
-                }
-                ...PostProductUnits
-                ...PostVideoFields
-                images(first: 1, croppingStrategy: SMART, height: 260, width: 333) {
-                  totalCount
-                  edges {
-                    node {
-                      ...ImageFields
-                      __typename
-                    }
-                    __typename
-                  }
-                  __typename
-                }
-                likedByCurrentUser
-                likesCount
-                text {
-                  text
-                  __typename
-                }
-                user {
-                  ...UserId
-                  ...UserAvatar
-                  nickname
-                  __typename
-                }
-                __typename
+                _id: externalId
               }
               species {
-                ...SpeciesId
+                _id: externalId
                 displayName
-                __typename
               }
-              __typename
+              user {
+                _id: externalId
+              }
+              weight
             }
-            __typename
           }
-          __typename
         }
-        __typename
-      }
-    }
-
-    fragment CatchId on Catch {
-      _id: externalId
-      __typename
-    }
-
-    fragment CatchFishingWaterName on Catch {
-      fishingWater {
-        ...FishingWaterId
-        displayName
-        latitude
-        longitude
-        __typename
-      }
-      __typename
-    }
-
-    fragment FishingWaterId on FishingWater {
-      _id: externalId
-      __typename
-    }
-
-    fragment CatchSpeciesName on Catch {
-      species {
-        ...SpeciesId
-        displayName
-        __typename
-      }
-      __typename
-    }
-
-    fragment SpeciesId on Species {
-      _id: externalId
-      __typename
-    }
+"""
 
-    fragment PostId on Post {
-      _id: externalId
-      __typename
+BBOX_QUERY = """
+    query GetCatchesInMapBoundingBox($boundingBox: BoundingBoxInputObject, $first: Int, $after: String, $caughtInMonths: [MonthEnum!], $speciesIds: [String!]) {
+      mapArea(boundingBox: $boundingBox) {""" + _CATCHES_SELECTION + """      }
     }
+"""
 
-    fragment PostProductUnits on Post {
-      productUnits(first: 20) {
-        edges {
-          node {
-            ...ProductUnitId
-            model
-            image {
-              ...ImageFields
-              __typename
-            }
-            product {
-              ...ProductId
-              ...ProductBrandName
-              displayName
-              __typename
-            }
-            __typename
-          }
-          __typename
+# Only the number of catches, to decide whether a bounding box must be split.
+# One catch is requested since a page of none may be rejected.
+_COUNT_SELECTION = """
+        catches(first: 1) {
+          totalCount
         }
-        __typename
-      }
-      __typename
-    }
-
-    fragment ImageFields on Image {
-      width
-      height
-      url
-      __typename
-    }
-
-    fragment ProductBrandName on Product {
-      brand {
-        ...BrandId
-        name
-        __typename
-      }
-      __typename
-    }
-
-    fragment BrandId on Brand {
-      id
-      __typename
-    }
-
-    fragment ProductId on Product {
-      _id: externalId
-      legacyId: id
-      __typename
-    }
+"""
 
-    fragment ProductUnitId on ProductUnit {
-      id
-      __typename
-    }
 
-    fragment PostVideoFields on Post {
-      video {
-        ...VideoId
-        hlsUrl
-        webUrl
-        originalUrl
-        screenshot(width: 600) {
-          ...ImageFields
-          __typename
+def _bounding_box_variable(bbox):
+    # [minx, miny, maxx, maxy]
+    return {
+        "southWest": {
+            "latitude": bbox[1],
+            "longitude": bbox[0]
+        },
+        "northEast": {
+            "latitude": bbox[3],
+            "longitude": bbox[2]
         }
-        __typename
-      }
-      __typename
     }
 
-    fragment VideoId on Video {
-      id
-      __typename
-    }
 
-    fragment UserAvatar on User {
-      avatar(croppingStrategy: CENTER, height: 128, width: 128) {
-        height
-        width
-        ...ImageFields
-        __typename
-      }
-      __typename
-    }
+@functools.lru_cache()
+def _batch_query(n_boxes, count_only=False):
+    """Build a document that queries many bounding boxes at once.
 
-    fragment UserId on User {
-      _id: externalId
-      __typename
-    }
-    """
-    r = requests.post(BASE_URL, json={'query': query, 'variables': variables})
-    try:
-        data = r.json()
-    except Exception as err:
-        print(r.text)
-        raise err
-    return data
-
-
-def query_catch(post_id):
-    query = """
-    query GetCatchDetails($externalId: String) {
-      catchDetails: post(externalId: $externalId) {
-        ...PostId
-        catchConditions: catch {
-          ...CatchId
-          caughtAtLocalTimeZone
-          latitude
-          longitude
-          moonIllumination
-          sunPosition
-          weatherAndMarineReading {
-            ...WeatherAndMarineReadingId
-            airPressure
-            airTemperature
-            waterTemperature
-            weatherCondition {
-              localizedValue
-              worldWeatherOnlineIdentifier
-              __typename
-            }
-            windDirection {
-              degrees
-              shortLocalizedValue
-              __typename
-            }
-            windSpeed
-            __typename
-          }
-          __typename
-        }
-        catchPost: catch {
-          ...CatchId
-          catchAndRelease
-          caughtAtGmt
-          createdAt
-          fishingMethod {
-            ...FishingMethodId
-            displayName
-            __typename
-          }
-          fishingWater {
-            ...FishingWaterId
-            displayName
-            latitude
-            longitude
-            __typename
-          }
-          hasExactPosition
-          length
-          locationPrivacy
-          species {
-            ...SpeciesId
-            displayName
-            __typename
-          }
-          user {
-            ...UserId
-            avatar {
-              url
-              __typename
-            }
-            nickname
-            __typename
-          }
-          weight
-          __typename
-        }
-        trip {
-          id
-          catches {
-            totalCount
-            __typename
-          }
-          __typename
-        }
-        catchGear: displayProductUnits(first: 20) {
-          edges {
-            node {
-              ...ProductUnitId
-              product {
-                ...ProductId
-                brand {
-                  ...BrandId
-                  name
-                  __typename
-                }
-                image {
-                  ...ImageFields
-                  __typename
-                }
-                displayName
-                __typename
-              }
-              __typename
-            }
-            __typename
-          }
-          __typename
-        }
-        __typename
-      }
-    }
-
-    fragment BrandId on Brand {
-      id
-      __typename
-    }
-
-    fragment CatchId on Catch {
-      _id: externalId
-      __typename
-    }
+    Each bounding box is an aliased ``mapArea`` field, ``box0`` to
+    ``box{n_boxes - 1}``, with its own ``$boundingBox{i}`` variable.
 
-    fragment FishingMethodId on FishingMethod {
-      _id: externalId
-      __typename
-    }
+    Args:
+        n_boxes (int): number of bounding boxes in the document.
+        count_only (bool): if True, only query the number of catches,
+            otherwise query the first page of catches.
 
-    fragment FishingWaterId on FishingWater {
-      _id: externalId
-      __typename
-    }
+    Returns:
+        string
 
-    fragment ImageFields on Image {
-      width
-      height
-      url
-      __typename
+    """
+    box_variables = ', '.join(
+        f'$boundingBox{i}: BoundingBoxInputObject' for i in range(n_boxes))
+    if count_only:
+        name = 'CountCatchesInMapBoundingBoxes'
+        selection = _COUNT_SELECTION
+    else:
+        name = 'GetCatchesInMapBoundingBoxes'
+        selection = _CATCHES_SELECTION
+        box_variables = (
+            '$first: Int, $after: String, $caughtInMonths: [MonthEnum!], '
+            '$speciesIds: [String!], ' + box_variables)
+    box_fields = ''.join(
+        f'      box{i}: mapArea(boundingBox: $boundingBox{i}) {{'
+        + selection + '      }\n'
+        for i in range(n_boxes))
+    return f'\n    query {name}({box_variables}) {{\n{box_fields}    }}\n'
+
+
+async def query_bounding_box(session, bbox, cursor):
+    variables = {
+        "boundingBox": _bounding_box_variable(bbox),
+        "first": 50,  # 50 seems to be max.
     }
+    if cursor:
+        variables['after'] = cursor
 
-    fragment SpeciesId on Species {
-      _id: externalId
-      __typename
-    }
+    return await _post_query(session, BBOX_QUERY, variables)
 
-    fragment PostId on Post {
-      _id: externalId
-      __typename
-    }
 
-    fragment ProductId on Product {
-      _id: externalId
-      legacyId: id
-      __typename
-    }
+async def query_bounding_box_batch(session, bbox_list, count_only=False):
+    """Query many bounding boxes in one request.
 
-    fragment ProductUnitId on ProductUnit {
-      id
-      __typename
-    }
+    Args:
+        session (aiohttp.ClientSession): session to send the request with.
+        bbox_list (list): bounding boxes as [minx, miny, maxx, maxy].
+        count_only (bool): if True, only query the number of catches in each
+            bounding box. Otherwise query the first page of catches.
 
-    fragment UserId on User {
-      _id: externalId
-      __typename
-    }
+    Returns:
+        list with one item per bounding box, shaped like the response of
+        ``query_bounding_box`` (with only ``totalCount`` if ``count_only``),
+        or None where the server returned no result for that bounding box.
 
-    fragment WeatherAndMarineReadingId on WeatherAndMarineReading {
-      id
-      __typename
-    }
     """
-    variables = {
-        'externalId': post_id
-    }
-    r = requests.post(BASE_URL, json={'query': query, 'variables': variables})
-    try:
-        return r.json()
-    except Exception as err:
-        print(r.text)
-        raise err
+    variables = {} if count_only else {"first": 50}
+    for i, bbox in enumerate(bbox_list):
+        variables[f'boundingBox{i}'] = _bounding_box_variable(bbox)
+    data = await _post_query(
+        session, _batch_query(len(bbox_list), count_only), variables)
+
+    results = []
+    for i in range(len(bbox_list)):
+        map_area = (data.get('data') or {}).get(f'box{i}')
+        results.append({'data': {'mapArea': map_area}} if map_area else None)
+    return results